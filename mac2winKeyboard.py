@@ -10,10 +10,19 @@ import sys
 import time
 
 import argparse
-import codecs
+import functools
+import itertools
 import unicodedata
 
-import xml.etree.ElementTree as ET
+from collections import defaultdict
+from dataclasses import dataclass
+
+try:
+    # lxml parses through the libxml2 C core, which is considerably
+    # faster than the pure-Python ElementTree parser.
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 # local modules
 from data.klc_data import (
@@ -39,6 +48,13 @@ error_msg_winmac_mismatch = (
     "// Could not match Windows code {} ('{}') to Mac OS code {}. Skipping.")
 
 
+class FilenameTooLongError(ValueError):
+    '''
+    Raised when a keyboard name cannot be truncated to a Windows-style
+    (8+3) file name.
+    '''
+
+
 # Change the line separator.
 # This is important, as the output klc file must be UTF-16 LE with
 # Windows-style line breaks.
@@ -48,6 +64,55 @@ os.linesep = '\r\n'
 # mapped to one key), which are not supported by this conversion script.
 replacement_char = '007E'
 
+# Patterns for normalizing the output attributes of a .keylayout file,
+# compiled once at import time.
+# rx_output_value classifies a whole attribute value in a single match:
+# a 'ligature' of several character references, a single character
+# reference, or a single literal character. Anything else (e.g. several
+# literal characters) does not match at all.
+rx_output_attr = re.compile(r'(output=[\"\'])(.+?)([\"\'])')
+rx_output_value = re.compile(
+    r'(?P<lig>(&#x[a-fA-F0-9]{4};){2,})'
+    r'|&#x(?P<hex>[a-fA-F0-9]{4,6});'
+    r'|(?P<char>.)')
+
+# win_keycodes never changes, so it is sorted once at import time
+# rather than on every key table. The two-digit hex keys sort the same
+# lexicographically as numerically.
+sorted_win_keycodes = sorted(win_keycodes.items())
+
+
+@dataclass(slots=True)
+class KeyData:
+    '''
+    A key as it is in the layout XML.
+    The deadkey_marker flag is set for real dead keys; it translates to
+    the '@' suffix used in .klc files.
+    '''
+
+    keymapset_id: str
+    keymap_index: int
+    key_code: int
+    key_type: str
+    output: str
+    deadkey_marker: bool = False
+
+
+@dataclass(slots=True)
+class ActionData:
+    '''
+    An action as it is in the layout XML.
+    The basekey (e.g. 0041, A) and deadkey (e.g. 02c6, circumflex)
+    fields are filled in while matching actions to their outputs.
+    '''
+
+    action_id: str
+    state: str
+    action_type: str
+    result: str
+    basekey: str = None
+    deadkey: str = None
+
 
 class KeylayoutParser(object):
 
@@ -68,14 +133,14 @@ class KeylayoutParser(object):
         self.deadkeys = {}
 
         # {deadkey: (basekey, output)}
-        self.deadkey_dict = {}
+        self.deadkey_dict = defaultdict(list)
 
         # A dict of dicts, collecting the outputs of every key
         # in each individual state.
         self.output_dict = {}
 
         # Actions that do not yield immediate output, but shift to a new state.
-        self.empty_actions = []
+        self.empty_actions = set()
 
         # {keymap ID: modifier key}
         self.keymap_assignments = {}
@@ -83,7 +148,6 @@ class KeylayoutParser(object):
         self.number_of_keymaps = 0
 
         self.parse(tree)
-        self.find_deadkeys()
         self.match_actions()
         self.find_outputs()
         self.make_deadkey_dict()
@@ -128,77 +192,77 @@ class KeylayoutParser(object):
         shiftcaps_max = {'anyShift', 'caps', 'anyOption?'}
         shiftcaps_min = {'anyShift', 'caps'}
 
-        for parent in tree.iter():
-
-            if parent.tag == 'keyMapSelect':
-                for modifier in parent:
-                    keymap_index = int(parent.get('mapIndex'))
-                    keymap_idx_list.append(keymap_index)
-
-                    keymap = parent.get('mapIndex')
-                    states = set(modifier.get('keys').split())
-
-                    self.check_states(
-                        states, keymap, default_max, default_min, 'default')
-                    self.check_states(
-                        states, keymap, shift_max, shift_min, 'shift')
-                    self.check_states(
-                        states, keymap, alt_max, alt_min, 'alt')
-                    self.check_states(
-                        states, keymap, altshift_max, altshift_min, 'altshift')
-                    self.check_states(
-                        states, keymap, cmd_max, cmd_min, 'cmd')
-                    self.check_states(
-                        states, keymap, caps_max, caps_min, 'caps')
-                    self.check_states(
-                        states, keymap, cmdcaps_max, cmdcaps_min, 'cmdcaps')
-                    self.check_states(
-                        states, keymap,
-                        shiftcaps_max, shiftcaps_min, 'shiftcaps')
-
-            if parent.tag == 'keyMapSet':
-                keymapset_id = parent.attrib['id']
-                for keymap in parent:
-                    keymap_index = int(keymap.attrib['index'])
-                    for key in keymap:
-                        key_code = int(key.attrib['code'])
-                        if key.get('action') is None:
-                            key_type = 'output'
-                        else:
-                            key_type = 'action'
-                        output = key.get(key_type)
-
-                        self.key_list.append([
-                            keymapset_id, keymap_index,
-                            key_code, key_type, output])
-
-            if parent.tag == 'actions':
-                for action in parent:
-                    action_id = action.get('id')
-                    for action_trigger in action:
-                        if action_trigger.get('next') is None:
-                            action_type = 'output'
-                        else:
-                            action_type = 'next'
-                        state = action_trigger.get('state')
-
-                        # result can be a code point or another state
-                        result = action_trigger.get(action_type)
-                        self.action_list.append([
-                            action_id, state, action_type, result])
-
-                        # Make a dictionary for key id to output.
-                        # On the Mac keyboard, the 'a' for example is often
-                        # matched to an action, as it can produce
-                        # agrave, aacute, etc.
-                        if [state, action_type] == ['none', 'output']:
-                            self.action_basekeys[action_id] = result
+        # Three targeted iterations, filtered by tag in the parser,
+        # instead of one full traversal with per-node tag checks.
+        for parent in tree.iter('keyMapSelect'):
+            for modifier in parent.findall('modifier'):
+                keymap_index = int(parent.get('mapIndex'))
+                keymap_idx_list.append(keymap_index)
+
+                keymap = parent.get('mapIndex')
+                states = set(modifier.get('keys').split())
+
+                self.check_states(
+                    states, keymap, default_max, default_min, 'default')
+                self.check_states(
+                    states, keymap, shift_max, shift_min, 'shift')
+                self.check_states(
+                    states, keymap, alt_max, alt_min, 'alt')
+                self.check_states(
+                    states, keymap, altshift_max, altshift_min, 'altshift')
+                self.check_states(
+                    states, keymap, cmd_max, cmd_min, 'cmd')
+                self.check_states(
+                    states, keymap, caps_max, caps_min, 'caps')
+                self.check_states(
+                    states, keymap, cmdcaps_max, cmdcaps_min, 'cmdcaps')
+                self.check_states(
+                    states, keymap,
+                    shiftcaps_max, shiftcaps_min, 'shiftcaps')
+
+        for parent in tree.iter('keyMapSet'):
+            keymapset_id = parent.attrib['id']
+            for keymap in parent.findall('keyMap'):
+                keymap_index = int(keymap.attrib['index'])
+                for key in keymap.findall('key'):
+                    key_code = int(key.attrib['code'])
+                    if key.get('action') is None:
+                        key_type = 'output'
+                    else:
+                        key_type = 'action'
+                    output = key.get(key_type)
+
+                    self.key_list.append(KeyData(
+                        keymapset_id, keymap_index,
+                        key_code, key_type, output))
+
+        for parent in tree.iter('actions'):
+            for action in parent.findall('action'):
+                action_id = action.get('id')
+                for action_trigger in action.findall('when'):
+                    if action_trigger.get('next') is None:
+                        action_type = 'output'
+                    else:
+                        action_type = 'next'
+                    state = action_trigger.get('state')
+
+                    # result can be a code point or another state
+                    result = action_trigger.get(action_type)
+                    self.action_list.append(ActionData(
+                        action_id, state, action_type, result))
+
+                    # Make a dictionary for key id to output.
+                    # On the Mac keyboard, the 'a' for example is often
+                    # matched to an action, as it can produce
+                    # agrave, aacute, etc.
+                    if [state, action_type] == ['none', 'output']:
+                        self.action_basekeys[action_id] = result
 
         # Yield the highest index assigned to a shift state - thus, the
         # number of shift states in the layout.
         self.number_of_keymaps = max(keymap_idx_list)
 
-    def find_deadkeys(self):
+    def match_actions(self):
         '''
         Populate dictionary self.deadkeys which contains the state ID
         and the code point of an actual dead key.
@@ -208,54 +272,46 @@ class KeylayoutParser(object):
         inputs that have no immediate output.
         This list is used later when an '@' is appended to the code points,
         a Windows convention to mark dead keys.
+
+        Then fill in the basekey field of the actions in
+        self.action_list, e.g.
+
+        ActionData(
+            action_id='6',
+            state='s1',
+            action_type='output',
+            result='00c1',  # Á
+            basekey='0041',  # A
+        )
+
+        The basekeys -- all the glyphs that can be combined with a dead
+        key, e.g. A,E,I etc. -- have already been collected in
+        self.action_basekeys by parse().
         '''
 
         deadkey_id = 0
-        key_list = []
-        for [key_id, state, key_type, result] in self.action_list:
-            if [state, key_type, result] == ['none', 'output', '0020']:
+        next_states = []
+        for action in self.action_list:
+            key_id = action.action_id
+            if (action.state, action.action_type, action.result) == (
+                    'none', 'output', '0020'):
                 deadkey_id = key_id
-            if key_id == deadkey_id and result != '0020':
-                self.deadkeys[state] = result
-
-            if [state, key_type] == ['none', 'next']:
-                key_list.append([key_id, result])
-                self.empty_actions.append(key_id)
+            if key_id == deadkey_id and action.result != '0020':
+                self.deadkeys[action.state] = action.result
 
-        key_list_2 = []
-        for state, result_state in key_list:
-            if result_state in self.deadkeys.keys():
-                cp_result = self.deadkeys[result_state]
-                key_list_2.append((state, cp_result))
+            if (action.state, action.action_type) == ('none', 'next'):
+                next_states.append((key_id, action.result))
+                self.empty_actions.add(key_id)
 
         # Add the actual deadkeys (grave, acute etc)
         # to the dict action_basekeys
-        self.action_basekeys.update(dict(key_list_2))
-
-    def match_actions(self):
-        '''
-        Extend self.action_list is extended by the base character, e.g.
-
-        [
-            '6', # action id
-            's1',  # state
-            'output',  # type
-            '00c1',  # Á
-            '0041',  # A
-        ]
-
-        Populate self.action_basekeys -- all the glyphs that can be combined
-        with a dead key, e.g. A,E,I etc.
-
-        '''
-
-        for action_data in self.action_list:
-            key_id, state, key_type, result = action_data
-            if [state, key_type] == ['none', 'output']:
-                self.action_basekeys[key_id] = result
+        for key_id, result_state in next_states:
+            if result_state in self.deadkeys:
+                self.action_basekeys[key_id] = self.deadkeys[result_state]
 
-            if key_id in self.action_basekeys.keys():
-                action_data.append(self.action_basekeys[key_id])
+        for action in self.action_list:
+            if action.action_id in self.action_basekeys:
+                action.basekey = self.action_basekeys[action.action_id]
 
     def find_outputs(self):
         '''
@@ -265,15 +321,15 @@ class KeylayoutParser(object):
         '''
 
         for key_data in self.key_list:
-            output = key_data[4]
+            output = key_data.output
             if output in self.empty_actions:
                 # If the key is a real dead key, mark it.
                 # This mark is used in 'make_output_dict'.
-                key_data.append('@')
+                key_data.deadkey_marker = True
 
             if output in self.action_basekeys:
-                key_data[3] = 'output'
-                key_data[4] = self.action_basekeys[output]
+                key_data.key_type = 'output'
+                key_data.output = self.action_basekeys[output]
                 self.output_list.append(key_data)
             else:
                 self.output_list.append(key_data)
@@ -286,17 +342,12 @@ class KeylayoutParser(object):
         '''
 
         for action in self.action_list:
-            if action[1] in self.deadkeys.keys():
-                action.append(self.deadkeys[action[1]])
-
-            if len(action) == 6:
-                deadkey = action[5]
-                basekey = action[4]
-                result = action[3]
-                if deadkey in self.deadkey_dict:
-                    self.deadkey_dict[deadkey].append((basekey, result))
-                else:
-                    self.deadkey_dict[deadkey] = [(basekey, result)]
+            if action.state in self.deadkeys:
+                action.deadkey = self.deadkeys[action.state]
+
+            if action.basekey and action.deadkey:
+                self.deadkey_dict[action.deadkey].append(
+                    (action.basekey, action.result))
 
     def make_output_dict(self):
         '''
@@ -305,63 +356,68 @@ class KeylayoutParser(object):
         Here, the filtering occurs:
         '''
 
-        first_keymapset = self.output_list[0][0]
+        first_keymapset = self.output_list[0].keymapset_id
         self.output_list = [key_data
                             for key_data in self.output_list
-                            if key_data[0] == first_keymapset]
+                            if key_data.keymapset_id == first_keymapset]
 
-        for key_data in self.output_list:
-            keymap_id = key_data[1]
-            key_id = key_data[2]
+        # template for filling the key ID output dict with dummy output,
+        # built once and copied per key
+        dummy_outputs = {
+            i: '-1' for i in range(self.number_of_keymaps + 1)}
 
-            # filling the key ID output dict with dummy output
-            li = []
-            for i in range(self.number_of_keymaps + 1):
-                li.append([i, '-1'])
-            self.output_dict[key_id] = dict(li)
+        for key_data in self.output_list:
+            key_id = key_data.key_code
+            self.output_dict[key_id] = dummy_outputs.copy()
 
         for key_data in self.output_list:
-            keymap_id = key_data[1]
-            key_id = key_data[2]
+            keymap_id = key_data.keymap_index
+            key_id = key_data.key_code
 
-            if len(key_data) == 5:
-                output = key_data[4]
-            else:
+            if key_data.deadkey_marker:
                 # The @ is marking this key as a deadkey in .klc files.
-                output = key_data[4] + '@'
+                output = key_data.output + '@'
+            else:
+                output = key_data.output
 
             self.output_dict[key_id][keymap_id] = output
 
-    def get_key_output(self, key_output_dict, state):
+    def get_key_table(self):
         '''
-        Used to find output per state, for every key.
-        If no output, return '-1' (a.k.a. not defined).
+        Yield the key table lines of the .klc file.
         '''
 
-        try:
-            output = key_output_dict[self.keymap_assignments[state]]
-        except KeyError:
-            output = '-1'
-        return output
-
-    def get_key_table(self):
-        kt_output = []
-        for win_kc_hex, win_kc_name in sorted(win_keycodes.items()):
+        # Resolve the shift states to keymap indexes once, rather than
+        # looking up self.keymap_assignments for every state of every
+        # key. A state that is not assigned resolves to None, which is
+        # never a key of the output dicts, so the output falls back to
+        # '-1' (a.k.a. not defined).
+        idx_default = self.keymap_assignments.get('default')
+        idx_shift = self.keymap_assignments.get('shift')
+        idx_alt = self.keymap_assignments.get('alt')
+        idx_altshift = self.keymap_assignments.get('altshift')
+        idx_caps = self.keymap_assignments.get('caps')
+        idx_cmd = self.keymap_assignments.get('cmd')
+        idx_cmdcaps = self.keymap_assignments.get('cmdcaps')
+        idx_shiftcaps = self.keymap_assignments.get('shiftcaps')
+
+        output_dict = self.output_dict
+
+        for win_kc_hex, win_kc_name in sorted_win_keycodes:
             win_kc_int = int(win_kc_hex, 16)
 
-            if win_kc_int not in win_to_mac_keycodes:
+            mac_kc = win_to_mac_keycodes.get(win_kc_int)
+            if mac_kc is None:
                 print(error_msg_macwin_mismatch.format(
-                    win_kc_int, win_keycodes[win_kc_hex]))
+                    win_kc_int, win_kc_name))
                 continue
 
-            mac_kc = win_to_mac_keycodes[win_kc_int]
-            if mac_kc not in self.output_dict:
+            outputs = output_dict.get(mac_kc)
+            if outputs is None:
                 print(error_msg_winmac_mismatch.format(
-                    win_kc_int, win_keycodes[win_kc_hex], mac_kc))
+                    win_kc_int, win_kc_name, mac_kc))
                 continue
 
-            outputs = self.output_dict[mac_kc]
-
             # The key_table follows the syntax of the .klc file.
             # The columns are as follows:
 
@@ -377,16 +433,16 @@ class KeylayoutParser(object):
             # key_table[9]: output for altGr-shift (= ctrl-alt-shift)
             # key_table[10]: descriptions.
 
-            key_table = list((win_kc_hex, win_kc_name)) + ([""] * 9)
+            key_table = [win_kc_hex, win_kc_name] + [''] * 9
 
-            default_output = self.get_key_output(outputs, 'default')
-            shift_output = self.get_key_output(outputs, 'shift')
-            alt_output = self.get_key_output(outputs, 'alt')
-            altshift_output = self.get_key_output(outputs, 'altshift')
-            caps_output = self.get_key_output(outputs, 'caps')
-            cmd_output = self.get_key_output(outputs, 'cmd')
-            cmdcaps_output = self.get_key_output(outputs, 'cmdcaps')
-            shiftcaps_output = self.get_key_output(outputs, 'shiftcaps')
+            default_output = outputs.get(idx_default, '-1')
+            shift_output = outputs.get(idx_shift, '-1')
+            alt_output = outputs.get(idx_alt, '-1')
+            altshift_output = outputs.get(idx_altshift, '-1')
+            caps_output = outputs.get(idx_caps, '-1')
+            cmd_output = outputs.get(idx_cmd, '-1')
+            cmdcaps_output = outputs.get(idx_cmdcaps, '-1')
+            shiftcaps_output = outputs.get(idx_shiftcaps, '-1')
 
             # Check if the caps lock output equals the shift key,
             # to set the caps lock status.
@@ -408,54 +464,53 @@ class KeylayoutParser(object):
             key_table[7] = cmdcaps_output
             key_table[8] = alt_output
             key_table[9] = altshift_output
+
+            desc_default = char_description(default_output)
+            desc_shift = char_description(shift_output)
             key_table[10] = (
-                f'// {char_description(default_output)}, '
-                f'{char_description(shift_output)}, '
+                f'// {desc_default}, '
+                f'{desc_shift}, '
                 f'{char_description(cmd_output)}, '
                 f'{char_description(cmdcaps_output)}, '
                 f'{char_description(alt_output)}, '
                 f'{char_description(altshift_output)}')  # key descriptions
 
-            kt_output.append('\t'.join(key_table))
+            yield '\t'.join(key_table)
 
             if key_table[3] == 'SGCap':
-                print('SGCap character converted: '
-                      'default: {}, shift: {}, '
-                      'caps: {}, shift+caps: {}'.format(
-                          char_description(default_output),
-                          char_description(shift_output),
-                          char_description(caps_output),
-                          char_description(shiftcaps_output)))
-                kt_output.append((
+                desc_caps = char_description(caps_output)
+                desc_shiftcaps = char_description(shiftcaps_output)
+                print(f'SGCap character converted: '
+                      f'default: {desc_default}, shift: {desc_shift}, '
+                      f'caps: {desc_caps}, shift+caps: {desc_shiftcaps}')
+                yield (
                     f'-1\t-1\t\t0\t{caps_output}\t'
                     f'{shiftcaps_output}\t\t\t\t\t'
-                    f'// {char_description(caps_output)}, '
-                    f'{char_description(shiftcaps_output)}'))
-        return kt_output
+                    f'// {desc_caps}, '
+                    f'{desc_shiftcaps}')
 
     def get_deadkey_table(self):
         '''
-        Summary of dead keys, and their results in all intended combinations.
+        Yield a summary of dead keys, and their results in all intended
+        combinations.
         '''
 
-        dk_table = ['']
+        yield ''
         for cp_dead, base_result_list in self.deadkey_dict.items():
             # we want the space character to be last in the list,
             # otherwise MSKLC complains (not sure if consequential)
             sorted_base_result_list = sorted(
                 base_result_list, key=lambda x: int(x[0], 16), reverse=True)
-            dk_table.extend([''])
-            dk_table.append(f'DEADKEY\t{cp_dead}')
-            dk_table.append('')
+            yield ''
+            yield f'DEADKEY\t{cp_dead}'
+            yield ''
 
             for cp_base, cp_result in sorted_base_result_list:
                 char_base = char_from_hex(cp_base)
                 char_result = char_from_hex(cp_result)
-                line = (
+                yield (
                     f'{cp_base}\t{cp_result}\t'
                     f'// {char_base} -> {char_result}')
-                dk_table.append(line)
-        return dk_table
 
     def get_keyname_dead(self):
         '''
@@ -486,27 +541,7 @@ def read_file(path):
     return data
 
 
-def codepoint_from_char(character):
-    '''
-    Return a 4 or 5-digit Unicode hex string for the passed character.
-    '''
-
-    try:
-        return '{0:04x}'.format(ord(character))
-
-        # For now, 'ligatures' (2 or more code points assigned to one key)
-        # are not supported in this conversion script.
-        # Ligature support on Windows keyboards is spotty (no ligatures in
-        # Caps Lock states, for instance), and limited to four code points
-        # per key. Used in very few keyboard layouts only, the decision was
-        # made to insert a placeholder instead.
-
-    except TypeError:
-        print(error_msg_conversion.format(
-            character, char_description(replacement_char)))
-        return replacement_char
-
-
+@functools.lru_cache(maxsize=None)
 def char_from_hex(hex_string):
     '''
     Return character from a Unicode code point.
@@ -515,6 +550,7 @@ def char_from_hex(hex_string):
     return chr(int(hex_string, 16))
 
 
+@functools.lru_cache(maxsize=None)
 def char_description(hex_string):
     '''
     Return description of characters, e.g. 'DIGIT ONE', 'EXCLAMATION MARK' etc.
@@ -526,56 +562,55 @@ def char_description(hex_string):
     try:
         return unicodedata.name(char_from_hex(hex_string))
     except ValueError:
-        return 'PUA {}'.format(hex_string)
+        return f'PUA {hex_string}'
 
 
-def filter_xml(input_keylayout):
+def parse_keylayout(input_keylayout):
     '''
-    Filter xml-based .keylayout file.
-    Unicode entities (&#x0000;) make the ElementTree xml parser choke,
-    that’s why some replacement operations are necessary.
+    Read and parse a xml-based .keylayout file in a single pass.
+    Character references to control characters (e.g. &#x0008;) are not
+    valid XML, that’s why the output attributes are normalized before
+    the file content is handed to the parser.
     Also, all literal output characters are converted to code points
     (0000, ffff, 1ff23 etc) for easier handling downstream.
     '''
 
-    rx_uni_lig = re.compile(r'((&#x[a-fA-F0-9]{4};){2,})')
-    rx_hex_escape = re.compile(r'&#x([a-fA-F0-9]{4,6});')
-    rx_output_line = re.compile(r'(output=[\"\'])(.+?)([\"\'])')
-
-    # Fixing the first line to make ElementTree not stumble
-    # over a capitalized XML tag
-    filtered_xml = ['<?xml version="1.0" encoding="UTF-8"?>']
-
-    for line in read_file(input_keylayout)[1:]:
-
-        if re.search(rx_output_line, line):
-            if re.search(rx_uni_lig, line):
-                # More than 1 output character.
-                # Not supported, so fill in replacement char instead.
-                lig_characters = re.search(rx_uni_lig, line).group(1)
-                print(error_msg_conversion.format(
-                    lig_characters, char_description(replacement_char)))
-                line = re.sub(rx_uni_lig, replacement_char.lower(), line)
-            elif re.search(rx_hex_escape, line):
-                # Escaped code point, e.g. &#x0020;
-                # Remove everything except the code point.
-                query = re.search(rx_hex_escape, line)
-                codepoint = query.group(1).lower()
-                line = re.sub(rx_hex_escape, codepoint, line)
-            else:
-                # Normal character output.
-                # Replace the character by a code point
-                query = re.search(rx_output_line, line)
-                char_pre = query.group(1)  # output="
-                character = query.group(2)
-                codepoint = codepoint_from_char(character).lower()
-                char_suff = query.group(3)  # "
-                replacement_line = ''.join((char_pre, codepoint, char_suff))
-                line = re.sub(rx_output_line, replacement_line, line)
+    def convert_output(match):
+        char_pre, value, char_suff = match.groups()  # output=" value "
+        query = rx_output_value.fullmatch(value)
+
+        if query is None or query.group('lig'):
+            # More than 1 output character.
+            # For now, 'ligatures' (2 or more code points assigned to
+            # one key) are not supported in this conversion script.
+            # Ligature support on Windows keyboards is spotty (no
+            # ligatures in Caps Lock states, for instance), and limited
+            # to four code points per key. Used in very few keyboard
+            # layouts only, the decision was made to insert a
+            # placeholder instead.
+            print(error_msg_conversion.format(
+                value, char_description(replacement_char)))
+            codepoint = replacement_char
+        elif query.group('hex'):
+            # Escaped code point, e.g. &#x0020;
+            # Remove everything except the code point.
+            codepoint = query.group('hex')
+        else:
+            # Normal character output.
+            # Replace the character by a 4 or 5-digit Unicode hex string.
+            character = query.group('char')
+            codepoint = f'{ord(character):04x}'
 
-        filtered_xml.append(line)
+        return ''.join((char_pre, codepoint.lower(), char_suff))
 
-    return '\n'.join(filtered_xml)
+    with open(input_keylayout, 'r', encoding='utf-8') as f:
+        raw_xml = f.read()
+
+    filtered_xml = rx_output_attr.sub(convert_output, raw_xml)
+
+    # lxml does not accept str input containing an encoding declaration,
+    # so the filtered XML is passed as UTF-8 bytes.
+    return ET.XML(filtered_xml.encode('utf-8'))
 
 
 def make_klc_filename(keyboard_name):
@@ -601,19 +636,16 @@ def make_klc_filename(keyboard_name):
     if match_digit:
         trunc = 8 - len(match_digit.group(1)) - 1
         if trunc < 0:
-            print(error_msg_filename)
-            sys.exit(-1)
+            raise FilenameTooLongError(error_msg_filename)
         else:
-            filename = '{}_{}.klc'.format(
-                filename[:trunc], match_digit.group(1))
+            filename = f'{filename[:trunc]}_{match_digit.group(1)}.klc'
     else:
-        filename = '{}.klc'.format(filename[:8])
+        filename = f'{filename[:8]}.klc'
     return filename
 
 
 def process_input_keylayout(input_keylayout):
-    filtered_xml = filter_xml(input_keylayout)
-    tree = ET.XML(filtered_xml)
+    tree = parse_keylayout(input_keylayout)
     keyboard_data = KeylayoutParser(tree)
     return keyboard_data
 
@@ -663,14 +695,14 @@ def make_klc_data(keyboard_name, keyboard_data):
     klc_prologue = make_klc_prologue(keyboard_name)
     klc_epilogue = make_klc_epilogue()
 
-    klc_data = []
-    klc_data.extend(klc_prologue.splitlines())
-    klc_data.extend(keyboard_data.get_key_table())
-    klc_data.extend(keyboard_data.get_deadkey_table())
-    klc_data.extend(klc_keynames)
-    klc_data.extend(keyboard_data.get_keyname_dead())
-    klc_data.extend(klc_epilogue.splitlines())
-    return klc_data
+    return list(itertools.chain(
+        klc_prologue.splitlines(),
+        keyboard_data.get_key_table(),
+        keyboard_data.get_deadkey_table(),
+        klc_keynames,
+        keyboard_data.get_keyname_dead(),
+        klc_epilogue.splitlines(),
+    ))
 
 
 def get_args(args=None):
@@ -707,14 +739,16 @@ def run(args):
     klc_data = make_klc_data(keyboard_name, keyboard_data)
 
     output_path = os.sep.join((output_dir, klc_filename))
-    with codecs.open(output_path, 'w', 'utf-16') as output_file:
-        for line in klc_data:
-            output_file.write(line)
-            output_file.write(os.linesep)
+    with open(output_path, 'w', encoding='utf-16', newline='') as output_file:
+        output_file.write(os.linesep.join(klc_data))
+        output_file.write(os.linesep)
 
     print(f'{keyboard_name} written to {klc_filename}')
 
 
 if __name__ == '__main__':
     args = get_args()
-    run(args)
+    try:
+        run(args)
+    except FilenameTooLongError as err:
+        sys.exit(err)
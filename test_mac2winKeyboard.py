@@ -52,9 +52,8 @@ class KLTest(unittest.TestCase):
         self.assertEqual(
             make_klc_filename('x1000000'), '_1000000.klc')
 
-        with self.assertRaises(SystemExit) as cm:
+        with self.assertRaises(FilenameTooLongError):
             make_klc_filename('100000000')
-        self.assertEqual(cm.exception.code, -1)
 
     def test_read_file(self):
         self.assertEqual(
@@ -84,20 +83,25 @@ class KLTest(unittest.TestCase):
             get_args([])
         self.assertEqual(cm.exception.code, 2)
 
-    def test_filter_xml(self):
-        self.assertEqual(
-            filter_xml(
-                os.path.join('tests', 'dummy.keylayout')),
-            '\n'.join(read_file(
-                os.path.join('tests', 'dummy_filtered.keylayout')))
-        )
+    def test_parse_keylayout(self):
+        tree = parse_keylayout(os.path.join('tests', 'dummy.keylayout'))
+        expected_tree = ET.parse(
+            os.path.join('tests', 'dummy_filtered.keylayout')).getroot()
+        outputs = [
+            elem.get('output') for elem in tree.iter()
+            if elem.get('output') is not None]
+        expected_outputs = [
+            elem.get('output') for elem in expected_tree.iter()
+            if elem.get('output') is not None]
+        self.assertTrue(outputs)
+        self.assertEqual(outputs, expected_outputs)
 
     def test_make_klc_data(self):
         input_keylayout = os.path.join('tests', 'us_test.keylayout')
         output_klc = os.path.join('tests', 'us_test.klc')
         keyboard_data = process_input_keylayout(input_keylayout)
         keyboard_name = make_keyboard_name(input_keylayout)
-        with codecs.open(output_klc, 'r', 'utf-16') as raw_klc:
+        with open(output_klc, 'r', encoding='utf-16') as raw_klc:
             klc_data = actualize_copyright_year(raw_klc.read())
         self.assertEqual(
             make_klc_data(keyboard_name, keyboard_data),
@@ -107,7 +111,7 @@ class KLTest(unittest.TestCase):
         output_klc = os.path.join('tests', 'dummy.klc')
         keyboard_data = process_input_keylayout(input_keylayout)
         keyboard_name = make_keyboard_name(input_keylayout)
-        with codecs.open(output_klc, 'r', 'utf-16') as raw_klc:
+        with open(output_klc, 'r', encoding='utf-16') as raw_klc:
             klc_data = actualize_copyright_year(raw_klc.read())
         self.assertEqual(
             make_klc_data(keyboard_name, keyboard_data),